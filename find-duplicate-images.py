@@ -16,91 +16,355 @@
 
 import argparse
 import collections
-import glob
-import json
-import multiprocessing
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import os
 import re
+import sqlite3
+import struct
 import subprocess
 import tempfile
 import webbrowser
 import zlib
 
 
-# I chose the value 8 (although it gives a few false positives), because 16 is
-# too large, and misses some duplicates.
+# Images are first compared with a perceptual "difference hash": each of its
+# THUMBNAIL_SIZE² bits tells whether a pixel of a tiny grayscale thumbnail is
+# brighter than its right neighbour. Images whose hashes differ by at most
+# HASH_DISTANCE bits are then compared with SSIM.
 THUMBNAIL_SIZE = 8
+HASH_DISTANCE = 4
 
-SSIM_THRESHOLD = 0.8
-
-
-def checksum_of_thumbnail(file):
-    with tempfile.NamedTemporaryFile(suffix='.png') as f:
-        subprocess.check_call((
-            'convert', '-auto-orient', file, '-resize',
-            f'{THUMBNAIL_SIZE}x{THUMBNAIL_SIZE}^', '-type', 'bilevel',
-            '-strip', f.name))
-
-        return file, zlib.crc32(f.read())
-
+# Flat, dark or overexposed images have almost all bits of their hash set to 0
+# (or to 1): such hashes with less than HASH_MIN_BITS bits different from the
+# others tell little about the image, so equal ones are still checked with
+# SSIM, and they are not compared with close hashes.
+HASH_MIN_BITS = 8
 
-def image_dimensions(file):
-    res = subprocess.check_output(('identify', '-format', '%w %h', file))
-    return res.decode().split(' ')
+# Maximum number of images whose hashes are computed by one convert process.
+CHECKSUM_BATCH_SIZE = 16
 
+SSIM_THRESHOLD = 0.8
 
-def image_is_rotated(file):
-    orientation = subprocess.check_output(
-        ('identify', '-format', '%[EXIF:orientation]', file),
-        stderr=subprocess.DEVNULL)
-    orientation = int(orientation or '1')
-    return orientation in (6, 8)  # 6: 90°, 8: 270°
-
-
-def compute_SSIM(file1, file2):
-    w1, h1 = image_dimensions(file1)
-    w2, h2 = image_dimensions(file2)
-    w1, h1 = (h1, w1) if image_is_rotated(file1) else (w1, h1)
-    w2, h2 = (h2, w2) if image_is_rotated(file2) else (w2, h2)
-
-    if w1 > w2:
-        file1, file2 = file2, file1
-        w1, h1, w2, h2 = w2, h2, w1, h1
-
-    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
-        if w1 == w2 and h1 == h2:
-            second = file2
-        else:
-            subprocess.check_call((
-                'convert', '-auto-orient', file2, '-resize', f'{w1}x{h1}!',
-                '-strip', f.name))
-            second = f.name
-
-        out = subprocess.run(
-            ('ffmpeg', '-nostdin', '-i', file1, '-i', second, '-lavfi', 'ssim',
-             '-f', 'null', '-'), stderr=subprocess.PIPE).stderr
-        res = [l for l in out.splitlines() if b' SSIM ' in l and b'All:' in l]
-        assert len(res) == 1, f'failed to parse ffmpeg output: {out}'
-        search = re.search(r' All:([01]\.[0-9]+) ', res[0].decode())
-        assert search, f'failed to parse ffmpeg output: {res[0]}'
-        ssim = float(search.group(1))
-
-        return file1, file2, ssim
+# Like the reference implementation of SSIM, images are downsampled so that
+# their smallest side is about this size before being compared. It is the
+# scale SSIM is meant for, and it saves a lot of computation on large photos.
+SSIM_SIZE = 256
+
+# Maximum number of images decoded by one ffmpeg process: larger groups of
+# candidates are split, to bound memory usage and keep all CPUs busy.
+SSIM_MAX_INPUTS = 32
+
+# ffmpeg filters to display images according to their EXIF orientation.
+ORIENTATION_FILTERS = {
+    2: 'hflip,', 3: 'hflip,vflip,', 4: 'vflip,',
+    5: 'transpose=cclock_flip,', 6: 'transpose=clock,',
+    7: 'transpose=clock_flip,', 8: 'transpose=cclock,',
+}
+
+JPEG_EXTENSIONS = frozenset(('.jpg', '.jpeg'))
+
+# Bump this when the way checksums or similarities are computed changes, to
+# invalidate results cached by previous versions.
+CACHE_VERSION = 7
+
+
+def walk(directory):
+    # Entries returned by os.scandir() know their type, which saves a stat()
+    # per file. Symbolic links to directories are not followed, to avoid loops.
+    # Like glob, directories that cannot be read (or that disappear while being
+    # scanned) are skipped.
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield from walk(entry.path)
+                elif (entry.is_file() and
+                        os.path.splitext(entry.name)[1].lower()
+                        in JPEG_EXTENSIONS):
+                    yield entry.path
+    except OSError:
+        return
+
+
+def find_jpeg_files(path):
+    if os.path.isdir(path):
+        return list(walk(path))
+    elif (os.path.isfile(path) and
+            os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS):
+        return [path]
+    return []
+
+
+def sha256_of_file(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return file, sha256.digest()
+
+
+def checksums_of_thumbnails(files):
+    """Compute difference hashes of several images, with one process.
+
+    Decoding is cheap thanks to `jpeg:size`, which lets libjpeg downscale
+    while decoding, so most of the time is spent starting convert: images are
+    processed by batches. Thumbnails are read as raw grayscale pixels from
+    stdout, concatenated in the order of files.
+    """
+    w, h = THUMBNAIL_SIZE + 1, THUMBNAIL_SIZE
+    command = ('convert', '-define', f'jpeg:size={2 * w}x{2 * w}', *files,
+               '-auto-orient', '-colorspace', 'gray', '-resize', f'{w}x{h}!',
+               '-depth', '8', 'gray:-')
+    if len(files) == 1:
+        thumbnails = subprocess.check_output(command)[:w * h]
+    else:
+        try:
+            thumbnails = subprocess.check_output(command)
+        except subprocess.CalledProcessError:
+            thumbnails = b''
+        if len(thumbnails) != w * h * len(files):
+            # An unreadable file, or a file with several frames: retry one by
+            # one, so that other images of the batch are not affected.
+            return [output for file in files
+                    for output in checksums_of_thumbnails([file])]
+
+    outputs = []
+    for i, file in enumerate(files):
+        thumbnail = thumbnails[i * w * h:(i + 1) * w * h]
+        checksum = 0
+        for y in range(h):
+            for x in range(w - 1):
+                left, right = thumbnail[y * w + x], thumbnail[y * w + x + 1]
+                checksum = checksum << 1 | (left > right)
+        outputs.append((file, checksum))
+
+    return outputs
+
+
+def is_low_detail(checksum):
+    ones = checksum.bit_count()
+    return not HASH_MIN_BITS <= ones <= THUMBNAIL_SIZE ** 2 - HASH_MIN_BITS
+
+
+def hamming_distance(checksum1, checksum2):
+    return (checksum1 ^ checksum2).bit_count()
+
+
+class HashIndex:
+    """Multi-index hashing, to find checksums close to a given one.
+
+    Checksums are split into `radius + 1` disjoint blocks of bits: by the
+    pigeonhole principle, two checksums that differ by at most `radius` bits
+    are equal on at least one block. Candidates are looked up by (block index,
+    block value), then confirmed by computing their Hamming distance.
+    """
+    def __init__(self, radius, bits=THUMBNAIL_SIZE ** 2):
+        self.radius = radius
+        n = radius + 1
+        self.blocks = [(bits * i // n, bits * (i + 1) // n) for i in range(n)]
+        self.entries = []
+        self.buckets = collections.defaultdict(list)
+
+    def _keys(self, checksum):
+        for i, (start, end) in enumerate(self.blocks):
+            yield i, checksum >> start & ((1 << (end - start)) - 1)
+
+    def add(self, checksum, item):
+        self.entries.append((checksum, item))
+        for key in self._keys(checksum):
+            self.buckets[key].append(len(self.entries) - 1)
+
+    def pairs(self):
+        """Yield pairs of items whose checksums are within the radius.
+
+        A pair is in the buckets of all blocks its checksums share: it is only
+        yielded for the first one.
+        """
+        for (block, _), indices in self.buckets.items():
+            for i, j in itertools.combinations(indices, 2):
+                (checksum1, item1), (checksum2, item2) = (self.entries[i],
+                                                          self.entries[j])
+                if (hamming_distance(checksum1, checksum2) <= self.radius and
+                        self._first_common_block(checksum1, checksum2) ==
+                        block):
+                    yield item1, item2
+
+    def _first_common_block(self, checksum1, checksum2):
+        return next(key1[0] for key1, key2 in zip(self._keys(checksum1),
+                                                  self._keys(checksum2))
+                    if key1 == key2)
+
+
+def exif_orientation(exif):
+    # `exif` starts with a TIFF header, followed by the first IFD, which holds
+    # the orientation tag (0x0112).
+    try:
+        byte_order = {b'II': '<', b'MM': '>'}[exif[:2]]
+        offset, = struct.unpack_from(byte_order + 'I', exif, 4)
+        count, = struct.unpack_from(byte_order + 'H', exif, offset)
+        for i in range(count):
+            tag, _, _, value = struct.unpack_from(
+                byte_order + 'HHIH', exif, offset + 2 + 12 * i)
+            if tag == 0x0112:
+                return value
+    except (KeyError, struct.error):
+        pass
+    return 1
+
+
+def jpeg_properties(file):
+    """Read width, height and EXIF orientation from JPEG segment headers.
+
+    Only headers are read, until the start-of-frame segment. Return None if
+    the file does not look like a valid JPEG image.
+    """
+    orientation = 1
+    with open(file, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            header = f.read(4)
+            if len(header) != 4 or header[0] != 0xff:
+                return None
+            marker, length = header[1], struct.unpack('>H', header[2:])[0]
+            if marker in (0xd9, 0xda) or length < 2:
+                return None  # EOI or SOS before any SOFn, or invalid length
+            elif marker == 0xe1:  # APP1
+                data = f.read(length - 2)
+                if data.startswith(b'Exif\0\0'):
+                    orientation = exif_orientation(data[6:])
+            elif 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                data = f.read(5)  # SOFn
+                if len(data) != 5:
+                    return None
+                _, h, w = struct.unpack('>BHH', data)
+                return (w, h, orientation) if w and h else None
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+
+@functools.cache
+def image_properties(file):
+    """Return width, height and EXIF orientation of an image.
+
+    Width and height are those of the displayed image, i.e. they are swapped
+    for images rotated by 90° or 270° (or transposed). They are read from
+    JPEG headers, which is much faster than spawning `identify`, used as a
+    fallback.
+    """
+    properties = jpeg_properties(file)
+    if properties is None:
+        res = subprocess.check_output(
+            ('identify', '-format', '%w %h %[EXIF:orientation]', file),
+            stderr=subprocess.DEVNULL)
+        w, h, orientation = res.decode().split(' ')
+        properties = int(w), int(h), int(orientation or '1')
+    w, h, orientation = properties
+    if orientation in (5, 6, 7, 8):  # transposed, 90°, transversed, 270°
+        w, h = h, w
+    return w, h, orientation
+
+
+def compute_SSIMs(pairs):
+    """Compute structural similarities of several pairs, with one process.
+
+    Each image is decoded, converted to grayscale and oriented according to
+    its EXIF metadata only once, then resized once per size it is compared
+    at, and split into as many streams as pairs use this size. Results are
+    parsed from the log of each named `ssim` filter.
+    """
+    results, sizes = [], collections.defaultdict(collections.Counter)
+    for file1, file2 in pairs:
+        w1, h1, _ = image_properties(file1)
+        w2, h2, _ = image_properties(file2)
+        if w1 > w2:
+            file1, file2 = file2, file1
+            w1, h1, w2, h2 = w2, h2, w1, h1
+
+        factor = max(1, round(min(w1, h1) / SSIM_SIZE))
+        w, h = w1 // factor, h1 // factor
+        sizes[file1][w, h] += 1
+        sizes[file2][w, h] += 1
+        results.append((file1, file2, w, h))
+
+    files = sorted(sizes)
+    graph, streams = [], {}
+    for i, file in enumerate(files):
+        orient = ORIENTATION_FILTERS.get(image_properties(file)[2], '')
+        graph.append(f'[{i}:v]format=gray,{orient}split={len(sizes[file])}' +
+                     ''.join(f'[in{i}_{j}]' for j in range(len(sizes[file]))))
+        for j, ((w, h), uses) in enumerate(sizes[file].items()):
+            scale = ('' if (w, h) == image_properties(file)[:2] else
+                     f'scale={w}:{h}:flags=area,')
+            streams[file, w, h] = [f'[in{i}_{j}_{k}]' for k in range(uses)]
+            graph.append(f'[in{i}_{j}]{scale}split={uses}' +
+                         ''.join(streams[file, w, h]))
+
+    for k, (file1, file2, w, h) in enumerate(results):
+        first, second = streams[file1, w, h].pop(), streams[file2, w, h].pop()
+        graph.append(f'{first}{second}ssim@{k}')
+
+    # EXIF orientations are applied by the filters above, disable automatic
+    # rotation of recent ffmpeg versions to get the same result with all.
+    inputs = itertools.chain.from_iterable(
+        ('-noautorotate', '-i', file) for file in files)
+    out = subprocess.run(
+        ('ffmpeg', '-nostdin', *inputs, '-lavfi', ';'.join(graph),
+         '-f', 'null', '-'), stderr=subprocess.PIPE).stderr
+
+    ssims = {}
+    for line in out.decode(errors='replace').splitlines():
+        search = re.search(
+            r'ssim@([0-9]+) .* SSIM .* All:([01]\.[0-9]+) ', line)
+        if search:
+            ssims[int(search.group(1))] = float(search.group(2))
+    assert len(ssims) == len(pairs), f'failed to parse ffmpeg output: {out}'
+
+    return [(file1, file2, ssims[k])
+            for k, (file1, file2, _, _) in enumerate(results)]
+
+
+def split_in_batches(pairs):
+    # Consecutive pairs usually share images, keep them in the same batch.
+    batch, files = [], set()
+    for pair in pairs:
+        if batch and len(files | set(pair)) > SSIM_MAX_INPUTS:
+            yield batch
+            batch, files = [], set()
+        batch.append(pair)
+        files.update(pair)
+    if batch:
+        yield batch
+
+
+@functools.cache
+def thread_pool():
+    # Workers spend their time waiting for external processes (convert,
+    # ffmpeg) or I/O, so threads are enough: no need to fork processes and to
+    # pickle arguments and results. The same pool is used by all steps.
+    return concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+
+
+def parallel_map(function, items):
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    return list(thread_pool().map(function, items))
 
 
 def ask_manual_comparison(file1, file2):
-    with (tempfile.NamedTemporaryFile(suffix='.jpg') as f1,
-            tempfile.NamedTemporaryFile(suffix='.jpg') as f2,
-            tempfile.NamedTemporaryFile(suffix='.jpg') as f):
-        subprocess.check_call((
-            'convert', '-auto-orient', file1, '-resize', '360x360',
-            '-background', 'white', '-gravity', 'center', '-extent', '400x400',
-            f1.name))
+    # Both thumbnails are generated and appended in memory by a single convert
+    # process, only the final image is written to disk.
+    thumbnail = ('-auto-orient', '-resize', '360x360', '-background', 'white',
+                 '-gravity', 'center', '-extent', '400x400')
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
         subprocess.check_call((
-            'convert', '-auto-orient', file2, '-resize', '360x360',
-            '-background', 'white', '-gravity', 'center', '-extent', '400x400',
-            f2.name))
-        subprocess.check_call(('convert', '+append', f1.name, f2.name, f.name))
+            'convert', '(', file1, *thumbnail, ')',
+            '(', file2, *thumbnail, ')', '+append', f.name))
         webbrowser.open(f.name)
 
         res = None
@@ -113,49 +377,80 @@ class Cache:
     def __init__(self):
         self.file = os.path.join(
             tempfile.gettempdir(),
-            f'find-duplicate-images-{os.getuid()}-cache.json')
-        self._load_from_disk()
-
-    def _load_from_disk(self):
-        try:
-            with open(self.file, 'r') as f:
-                contents = json.loads(f.read())
-                self.checksums = contents.get('checksums', {})
-                self.similarities = contents.get('similarities', {})
-        except FileNotFoundError:
-            self.checksums = {}
-            self.similarities = {}
-
-    def _save_to_disk(self):
-        with open(self.file, 'w') as f:
-            json.dump({'checksums': self.checksums,
-                       'similarities': self.similarities}, f)
-
+            f'find-duplicate-images-{os.getuid()}-cache.sqlite')
+        self.db = sqlite3.connect(self.file)
+        # Write-ahead logging makes each commit an append to the log, instead
+        # of a rewrite of the database.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version != CACHE_VERSION:
+            with self.db:
+                self.db.execute('DROP TABLE IF EXISTS checksums')
+                self.db.execute('DROP TABLE IF EXISTS similarities')
+                self.db.execute('CREATE TABLE checksums ('
+                                'path_hash INTEGER PRIMARY KEY, '
+                                'checksum INTEGER)')
+                self.db.execute('CREATE TABLE similarities ('
+                                'pair_key INTEGER PRIMARY KEY, ssim REAL)')
+                self.db.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+
+    # Memoized, because it is called for every lookup and save of each file
+    # and each pair.
+    @functools.cache
     def path_hash(self, file):
-        return str(zlib.crc32(os.path.abspath(file).encode()))
-
-    def get_checksum(self, file):
-        return self.checksums.get(self.path_hash(file))
+        # Modification time and size are part of the key, so that entries of
+        # files modified since they were cached are not used anymore.
+        stat = os.stat(file)
+        key = f'{os.path.abspath(file)}|{stat.st_mtime_ns}|{stat.st_size}'
+        return zlib.crc32(key.encode())
+
+    def _select(self, table, key, column, keys):
+        # Look up many keys with a few queries, instead of one query per key.
+        keys, values = list(keys), {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            values.update(self.db.execute(
+                f'SELECT {key}, {column} FROM {table} '
+                f'WHERE {key} IN ({", ".join("?" * len(chunk))})', chunk))
+        return values
+
+    def get_checksums(self, files):
+        hashes = {file: self.path_hash(file) for file in files}
+        values = self._select('checksums', 'path_hash', 'checksum',
+                              hashes.values())
+        # SQLite integers are signed, checksums are unsigned 64-bit integers.
+        return {file: values[h] + (1 << 63)
+                for file, h in hashes.items() if h in values}
 
     def save_checksums(self, results):
-        self._load_from_disk()
-        new = {self.path_hash(file): checksum for file, checksum in results}
-        self.checksums = self.checksums | new
-        self._save_to_disk()
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO checksums VALUES (?, ?)',
+                ((self.path_hash(file), checksum - (1 << 63))
+                 for file, checksum in results))
 
     def paths_hash(self, file1, file2):
+        # Both 32-bit hashes are packed in a signed 64-bit integer, the type of
+        # SQLite's integer keys.
         h1, h2 = self.path_hash(file1), self.path_hash(file2)
-        h1, h2 = min(int(h1), int(h2)), max(int(h1), int(h2))
-        return f'{h1} {h2}'
+        return (min(h1, h2) << 32 | max(h1, h2)) - (1 << 63)
 
-    def get_similarity(self, file1, file2):
-        return self.similarities.get(self.paths_hash(file1, file2))
+    def get_similarities(self, pairs):
+        hashes = {pair: self.paths_hash(*pair) for pair in pairs}
+        values = self._select('similarities', 'pair_key', 'ssim',
+                              hashes.values())
+        return {pair: values[h] for pair, h in hashes.items() if h in values}
 
     def save_similarities(self, results):
-        self._load_from_disk()
-        new = {self.paths_hash(f1, f2): ssim for f1, f2, ssim in results}
-        self.similarities = self.similarities | new
-        self._save_to_disk()
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO similarities VALUES (?, ?)',
+                ((self.paths_hash(f1, f2), ssim) for f1, f2, ssim in results))
+
+    def close(self):
+        # Closing the last connection checkpoints the write-ahead log into the
+        # database, and removes it.
+        self.db.close()
 
 
 def main():
@@ -168,59 +463,121 @@ def main():
                         help='show an image to manually confirm duplicates')
     args = parser.parse_args()
 
-    full_paths = args.path
-    files = set()
-    for path in full_paths:
-        if os.path.isfile(path):
-            _, ext = os.path.splitext(path)
-            if ext.lower() in ('.jpg', '.jpeg'):
-                files.add(path)
-        else:
-            full_paths += glob.glob(path + '/*')
+    files = set(itertools.chain.from_iterable(
+        parallel_map(find_jpeg_files, args.path)))
 
     print(f'Found {len(files)} JPEG files to check')
 
+    # Byte-identical files (backups, synchronized folders…) are duplicates
+    # without needing visual comparison: only one of them is kept for the next
+    # steps. Only files sharing their size with another one are read.
+    sizes = collections.defaultdict(list)
+    for file in files:
+        sizes[os.path.getsize(file)].append(file)
+    todo = [file for bucket in sizes.values() if len(bucket) > 1
+            for file in bucket]
+    digests = collections.defaultdict(list)
+    for file, digest in parallel_map(sha256_of_file, todo):
+        digests[digest].append(file)
+    identical = []
+    for bucket in digests.values():
+        original, *copies = sorted(bucket)
+        identical += [(original, copy, 1.0) for copy in copies]
+        files.difference_update(copies)
+    print(f'Found {len(identical)} copies of identical files')
+
     cache = Cache()
 
-    cached = [(f, cache.get_checksum(f)) for f in files]
-    todo = [f for f, c in cached if c is None]
-    cached_outputs = [(f, c) for f, c in cached if c is not None]
+    # A single mapping of files to checksums is kept and completed in place,
+    # rather than lists of (file, checksum) tuples concatenated and copied.
+    checksums = cache.get_checksums(files)
+    todo = [f for f in files if f not in checksums]
     print(f'Computing {len(todo)} visually-tolerant checksums of '
-          f'images (found {len(cached_outputs)} in cache)…')
-    outputs = multiprocessing.Pool().map(checksum_of_thumbnail, todo)
+          f'images (found {len(checksums)} in cache)…')
+    size = max(1, min(CHECKSUM_BATCH_SIZE,
+                      len(todo) // (os.cpu_count() or 1)))
+    batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+    outputs = list(itertools.chain.from_iterable(
+        parallel_map(checksums_of_thumbnails, batches)))
     cache.save_checksums(outputs)
-    outputs = cached_outputs + outputs
-
-    checksums = [i[1] for i in outputs]
-    redundant = [i for i, n in collections.Counter(checksums).items() if n > 1]
-    duplicates = [[i[0] for i in outputs if i[1] == s] for s in redundant]
-    n = len(set.union(set(), *(set(list) for list in duplicates)))
-    print(f'Found {n} potentially identical images')
-
-    pairs = []
-    for matches in duplicates:
-        for i in range(len(matches)):
-            for j in range(i + 1, len(matches)):
-                pairs.append((matches[i], matches[j]))
-
-    cached = [(*p, cache.get_similarity(*p)) for p in pairs]
-    todo = [(f1, f2) for f1, f2, s in cached if s is None]
-    cached_outputs = [(f1, f2, s) for f1, f2, s in cached if s is not None]
-    print(f'Computing structural similarity of {len(todo)} pairs of images '
-          f'(found {len(cached_outputs)} in cache)…')
-    outputs = multiprocessing.Pool().starmap(compute_SSIM, todo)
+    checksums.update(outputs)
+
+    # Bucket files by checksum in a single pass: files of a bucket are
+    # candidates, and the index only holds distinct checksums. Close buckets
+    # are then found by comparing checksums that share a block of bits, i.e.
+    # about (HASH_DISTANCE + 1) × D² / 2¹³ comparisons for D distinct random
+    # checksums, instead of D² for all pairs.
+    buckets = collections.defaultdict(list)
+    for file, checksum in checksums.items():
+        buckets[checksum].append(file)
+    neighbours = collections.defaultdict(set)
+    index = HashIndex(HASH_DISTANCE)
+    for checksum, bucket in buckets.items():
+        if not is_low_detail(checksum):  # would chain unrelated images
+            index.add(checksum, bucket)
+        if len(bucket) > 1:
+            for file in bucket:
+                neighbours[file].update(bucket)
+                neighbours[file].discard(file)
+    for bucket1, bucket2 in index.pairs():
+        for file in bucket1:
+            neighbours[file].update(bucket2)
+        for file in bucket2:
+            neighbours[file].update(bucket1)
+    print(f'Found {len(neighbours)} potentially identical images')
+
+    # Group candidates by connected components, so that each image is decoded
+    # only once when computing SSIM.
+    duplicates, seen = [], set()
+    for file in sorted(neighbours):
+        if file in seen:
+            continue
+        pairs, stack = [], [file]
+        seen.add(file)
+        while stack:
+            file1 = stack.pop()
+            for file2 in sorted(neighbours[file1]):
+                if file1 < file2:
+                    pairs.append((file1, file2))
+                if file2 not in seen:
+                    seen.add(file2)
+                    stack.append(file2)
+        duplicates.append(pairs)
+
+    cached = cache.get_similarities(itertools.chain.from_iterable(duplicates))
+    cached_outputs, same_hash, todo = [], [], []
+    for pairs in duplicates:
+        uncached = []
+        for pair in pairs:
+            checksum = checksums[pair[0]]
+            if checksum == checksums[pair[1]] and not is_low_detail(checksum):
+                # Identical perceptual hashes of detailed images are a strong
+                # enough sign, SSIM is not computed (None) for these pairs.
+                same_hash.append((*pair, None))
+            elif pair in cached:
+                cached_outputs.append((*pair, cached[pair]))
+            else:
+                uncached.append(pair)
+        todo += split_in_batches(uncached)
+    print(f'Computing structural similarity of {sum(map(len, todo))} pairs '
+          f'of images (found {len(cached_outputs)} in cache, skipped '
+          f'{len(same_hash)} with identical hashes)…')
+    outputs = parallel_map(compute_SSIMs, todo)
+    outputs = [output for group in outputs for output in group]
     cache.save_similarities(outputs)
-    outputs = cached_outputs + outputs
+    cache.close()
+    outputs = identical + same_hash + cached_outputs + outputs
 
     for file1, file2, ssim in outputs:
-        if ssim >= SSIM_THRESHOLD:
-            print(f'\nImages are potentially the same (SSIM = {ssim}):')
+        if ssim is None or ssim >= SSIM_THRESHOLD:
+            reason = 'same hash' if ssim is None else f'SSIM = {ssim}'
+            print(f'\nImages are potentially the same ({reason}):')
             if args.manual_validation:
                 if not ask_manual_comparison(file1, file2):
                     continue
                 print('You confirmed that images ARE the same:')
-            size1 = '×'.join(image_dimensions(file1))
-            size2 = '×'.join(image_dimensions(file2))
+            size1 = '{}×{}'.format(*image_properties(file1))
+            size2 = '{}×{}'.format(*image_properties(file2))
             print(f'    {size1: <13}  {repr(file1)}')
             print(f'    {size2: <13}  {repr(file2)}')
 